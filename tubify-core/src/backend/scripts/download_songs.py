@@ -19,7 +19,7 @@ DOWNLOADED_SONGS_CACHE = "downloaded_song_ids.pkl"
 SONGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "songs")
 # max workers for concurrent downloads - adjust based on your hardware
 MAX_WORKERS = 4
-# semaphore to limit concurrent downloads and avoid rate limiting
+# number of download workers, limits concurrent downloads to avoid rate limiting
 MAX_CONCURRENT_DOWNLOADS = 4  # reduced to avoid being flagged as a bot
 
 # ensure download directory exists
@@ -169,31 +169,32 @@ async def main():
         f"using concurrent downloads with {MAX_WORKERS} workers and {MAX_CONCURRENT_DOWNLOADS} max concurrent downloads"
     )
 
-    # use a semaphore to limit concurrent downloads
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
-
     # track progress
     start_time = time.time()
     total_songs = len(songs_to_download)
     processed = 0
     success_count = 0
 
-    # progress tracking
-    print_lock = threading.Lock()
+    # queue of songs to download, drained by a fixed number of workers so only
+    # MAX_CONCURRENT_DOWNLOADS tasks exist regardless of library size
+    queue = asyncio.Queue()
+    for song_id in songs_to_download:
+        queue.put_nowait(song_id)
 
-    # convert to list for processing
-    songs_list = list(songs_to_download)
+    loop = asyncio.get_running_loop()
 
-    # function to download with semaphore control and progress tracking
-    async def download_with_semaphore(song_id):
+    # worker that downloads songs from the queue until it is empty
+    async def worker():
         nonlocal processed, success_count
-        async with semaphore:
-            # use executor to run the blocking download in a separate thread
-            loop = asyncio.get_running_loop()
-            song_id, success = await loop.run_in_executor(None, download_song, song_id)
+        while not queue.empty():
+            song_id = queue.get_nowait()
+            try:
+                # use executor to run the blocking download in a separate thread
+                song_id, success = await loop.run_in_executor(
+                    None, download_song, song_id
+                )
 
-            # update progress atomically
-            with print_lock:
+                # update progress, no lock needed since workers run on the event loop thread
                 processed += 1
                 if success:
                     success_count += 1
@@ -209,12 +210,12 @@ async def main():
                     f"Success: {success_count} - "
                     f"ETA: {eta:.1f}s"
                 )
-
-            return song_id, success
+            finally:
+                queue.task_done()
 
     # download songs concurrently
-    download_tasks = [download_with_semaphore(song_id) for song_id in songs_list]
-    results = await asyncio.gather(*download_tasks)
+    workers = [asyncio.create_task(worker()) for _ in range(MAX_CONCURRENT_DOWNLOADS)]
+    await asyncio.gather(*workers)
 
     # all songs have been processed and individual results already saved
     # we just need to print the final statistics
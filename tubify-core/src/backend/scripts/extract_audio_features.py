@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 import os
-import json
 import numpy as np
 import librosa
+import numba
+import scipy.fft
+import soundfile as sf
+import soxr
 import asyncio
+import asyncpg
 import concurrent.futures
-import threading
+import itertools
+import multiprocessing
 import time
 from databases import Database
 from dotenv import load_dotenv
 import pickle
+import json
 import logging
 import psutil
 import warnings
@@ -30,25 +36,97 @@ load_dotenv()
 # directory containing audio files
 SONGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "songs")
 
-# file to store processed song ids
+# append-only record of processed song ids, one per line
 PROCESSED_SONGS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "processed_song_ids.txt"
+)
+# pickle written by earlier versions; only read to seed the text file on its
+# first run, and left in place
+LEGACY_PROCESSED_SONGS_FILE = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "processed_song_ids.pkl"
 )
 
 # hardware acceleration settings
 # determine optimal number of workers based on CPU count
-CPU_COUNT = psutil.cpu_count(logical=False) or 1  # physical cores, fallback to 1
-MAX_WORKERS = 12  # leave one core free for system processes
-BATCH_SIZE = 10  # number of songs to process in each batch
-
-# threading lock for safe updates to shared data
-pickle_lock = threading.Lock()
+# cores this process may run on, which respects container cpu sets, falling
+# back to the physical core count where affinity isn't available
+try:
+    CPU_COUNT = len(os.sched_getaffinity(0))
+except AttributeError:
+    CPU_COUNT = psutil.cpu_count(logical=False) or 1
+CPU_WORKERS = max(1, CPU_COUNT - 1)  # leave one core free for system processes
+# recycle worker processes so per-song allocations are returned to the os
+MAX_TASKS_PER_CHILD = 50
+BATCH_SIZE = 10  # number of processed songs to store in each database batch
+MAX_IN_FLIGHT = CPU_WORKERS * 2  # tasks submitted to the pool at any time
+# threads decoding audio ahead of the worker processes, decoding mostly waits on
+# disk so this can exceed the core count
+IO_WORKERS = min(64, CPU_COUNT * 4)
+# songs whose stfts share a single cufft call on the gpu, bounded by gpu memory
+GPU_BATCH_SIZE = 4
+
+# analysis sampling rate - perceptual features don't need the native 44.1kHz
+SAMPLE_RATE = 22050
+
+# long songs are analyzed from a representative excerpt rather than in full,
+# skipping the intro. songs shorter than the excerpt's end are analyzed whole
+EXCERPT_OFFSET = 30  # seconds
+EXCERPT_DURATION = 60  # seconds
+
+# stft / mel settings shared by every song (librosa defaults)
+N_FFT = 2048
+HOP_LENGTH = 512
+N_MELS = 128
+N_MFCC = 13
+N_CHROMA = 12
+N_CONTRAST = 7  # 6 spectral contrast bands plus the residual band
+
+# feature vector layout: mfcc, chroma and spectral contrast means, then the
+# 11 scalar features
+FEATURE_VECTOR_SIZE = N_MFCC + N_CHROMA + N_CONTRAST + 11
+
+# filter banks depend only on the settings above, so build them once. all of
+# them are float32 so products with the float32 spectrograms stay single precision
+HANN_WINDOW = librosa.filters.get_window("hann", N_FFT, fftbins=True).astype(np.float32)
+MEL_FB = librosa.filters.mel(sr=SAMPLE_RATE, n_fft=N_FFT, n_mels=N_MELS)
+# chroma filter bank at standard tuning, skipping chroma_stft's per-song tuning estimate
+CHROMA_FB = librosa.filters.chroma(sr=SAMPLE_RATE, n_fft=N_FFT, n_chroma=N_CHROMA)
+MFCC_DCT = scipy.fft.dct(
+    np.eye(N_MELS, dtype=np.float32), type=2, norm="ortho", axis=0
+)[:N_MFCC]
+FFT_FREQS = librosa.fft_frequencies(sr=SAMPLE_RATE, n_fft=N_FFT).astype(np.float32)
+MEL_FREQS = librosa.mel_frequencies(n_mels=N_MELS, fmin=0, fmax=SAMPLE_RATE / 2)
+VOCAL_IDX = np.where((MEL_FREQS >= 300) & (MEL_FREQS <= 3000))[0]
+
+# krumhansl-kessler key profiles rotated to all 12 tonics, major keys first.
+# templates are zero-mean and unit-norm so a dot product with a centered chroma
+# vector ranks keys by correlation
+MAJOR_PROFILE = np.array(
+    [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+)
+MINOR_PROFILE = np.array(
+    [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+)
+KEY_TEMPLATES = np.array(
+    [
+        np.roll(profile, k)
+        for profile in (MAJOR_PROFILE, MINOR_PROFILE)
+        for k in range(12)
+    ]
+)
+KEY_TEMPLATES -= KEY_TEMPLATES.mean(axis=1, keepdims=True)
+KEY_TEMPLATES /= np.linalg.norm(KEY_TEMPLATES, axis=1, keepdims=True)
+KEY_TEMPLATES = KEY_TEMPLATES.astype(np.float32)
 
 # check if GPU acceleration via cupy is available
 try:
     import cupy as cp
+    import cupyx
 
     HAS_GPU = True
+    # page-locked host buffer signals are staged in before copying to the gpu,
+    # grown as needed and reused for every batch in the process
+    pinned_staging = None
     logger.info("GPU acceleration enabled via cupy")
 except ImportError:
     HAS_GPU = False
@@ -65,100 +143,265 @@ async def get_all_song_ids(database):
         return []
 
 
+async def get_stored_song_ids(database):
+    """get the ids of songs that already have audio features stored"""
+    try:
+        rows = await database.fetch_all("SELECT song_id FROM song_audio_features")
+        return {row["song_id"] for row in rows}
+    except Exception as e:
+        logger.error(f"error fetching stored song ids: {e}")
+        return set()
+
+
 def load_processed_song_ids():
-    """load the list of already processed song ids"""
+    """load the set of already processed song ids"""
+    processed_song_ids = set()
     if os.path.exists(PROCESSED_SONGS_FILE):
         try:
-            with pickle_lock:
-                with open(PROCESSED_SONGS_FILE, "rb") as f:
-                    return pickle.load(f)
+            with open(PROCESSED_SONGS_FILE, "r") as f:
+                processed_song_ids.update(line.strip() for line in f if line.strip())
         except Exception as e:
             logger.error(f"error loading processed song ids: {e}")
-    return set()
+        return processed_song_ids
+
+    # first run with the text file: seed it from the legacy pickle
+    if os.path.exists(LEGACY_PROCESSED_SONGS_FILE):
+        try:
+            with open(LEGACY_PROCESSED_SONGS_FILE, "rb") as f:
+                processed_song_ids.update(pickle.load(f))
+        except Exception as e:
+            logger.error(f"error loading legacy processed song ids: {e}")
+    compact_processed_song_ids(processed_song_ids)
+    return processed_song_ids
 
 
-def save_processed_song_ids(processed_song_ids):
-    """save the updated list of processed song ids"""
+def compact_processed_song_ids(processed_song_ids):
+    """rewrite the processed song id file with each id once"""
     try:
-        with pickle_lock:
-            temp_file = f"{PROCESSED_SONGS_FILE}.tmp"
-            with open(temp_file, "wb") as f:
-                pickle.dump(processed_song_ids, f)
-            os.replace(temp_file, PROCESSED_SONGS_FILE)
+        temp_file = f"{PROCESSED_SONGS_FILE}.tmp"
+        with open(temp_file, "w") as f:
+            f.write("".join(f"{song_id}\n" for song_id in processed_song_ids))
+        os.replace(temp_file, PROCESSED_SONGS_FILE)
     except Exception as e:
-        logger.error(f"error saving processed song ids: {e}")
+        logger.error(f"error compacting processed song ids: {e}")
+
+
+def append_processed_song_ids(processed_log, song_ids):
+    """append newly processed song ids to the log"""
+    if not song_ids:
+        return
+    processed_log.write("".join(f"{song_id}\n" for song_id in song_ids))
+    processed_log.flush()
+    os.fsync(processed_log.fileno())
+
+
+def pinned_staging_buffer(shape):
+    """page-locked float32 host buffer of the given shape, reused across batches
+    since allocating pinned memory is expensive"""
+    global pinned_staging
+    size = int(np.prod(shape))
+    if pinned_staging is None or pinned_staging.size < size:
+        pinned_staging = cupyx.empty_pinned(size, dtype=np.float32)
+    return pinned_staging[:size].reshape(shape)
+
+
+def gpu_stft_magnitude(signals):
+    """magnitude stfts of several signals from a single batched cufft call,
+    matching librosa.stft's centered framing"""
+    # zero-pad so frames are centered, as librosa.stft does
+    n_frames = [1 + len(y) // HOP_LENGTH for y in signals]
+    # round the batch length up to whole frame blocks so similar batches share
+    # the same fft shape, and with it a cached cufft plan
+    block = 1024
+    max_frames = -(-max(n_frames) // block) * block
+    length = (max_frames - 1) * HOP_LENGTH + N_FFT
+    # assemble the padded batch in pinned memory so it reaches the gpu in a
+    # single full-bandwidth copy instead of one pageable copy per song
+    host = pinned_staging_buffer((len(signals), length))
+    for i, y in enumerate(signals):
+        host[i, : N_FFT // 2] = 0
+        host[i, N_FFT // 2 : N_FFT // 2 + len(y)] = y
+        host[i, N_FFT // 2 + len(y) :] = 0
+    y_gpu = cp.empty((len(signals), length), dtype=cp.float32)
+    y_gpu.set(host)
+
+    # view every signal as overlapping frames and run one batched cufft over them
+    frames = cp.lib.stride_tricks.as_strided(
+        y_gpu,
+        shape=(len(signals), max_frames, N_FFT),
+        strides=(length * y_gpu.itemsize, HOP_LENGTH * y_gpu.itemsize, y_gpu.itemsize),
+    )
+    S_gpu = cp.abs(cp.fft.rfft(frames * cp.asarray(HANN_WINDOW), axis=-1))
+    # device buffers go back to cupy's memory pool, where the next batch of
+    # the same bucketed shape reuses them without another cudaMalloc
+    S = cp.asnumpy(S_gpu)
+
+    # trim the padding frames off each song
+    return [S[i, :frames_i].T for i, frames_i in enumerate(n_frames)]
 
 
-def extract_audio_features(file_path):
-    """extract audio features from a song file using librosa with GPU acceleration if available"""
+def stft_magnitude(signals):
+    """magnitude stfts of a list of signals, batched on the gpu when available"""
+    if HAS_GPU:
+        try:
+            return gpu_stft_magnitude(signals)
+        except Exception as e:
+            # log the error and fall back to CPU processing
+            logger.warning(f"gpu stft failed, falling back to cpu: {e}")
+            cp.get_default_memory_pool().free_all_blocks()  # clear GPU memory
+    return [
+        np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)) for y in signals
+    ]
+
+
+@numba.njit(cache=True, fastmath=True)
+def spectral_frame_stats(S_mag, freqs):
+    """per-frame mean power, spectral centroid, rms and spectral flatness of a
+    magnitude spectrogram, fused into a single pass over it. matches librosa's
+    spectral_centroid, rms and spectral_flatness for the same stft"""
+    n_bins, n_frames = S_mag.shape
+    frame_power = np.empty(n_frames, dtype=np.float32)
+    centroid = np.empty(n_frames, dtype=np.float32)
+    rms = np.empty(n_frames, dtype=np.float32)
+    flatness = np.empty(n_frames, dtype=np.float32)
+    # frames outer, bins inner: the stft magnitudes from librosa and the gpu
+    # path are both f-ordered (frame-major), so each frame's bins are read
+    # sequentially
+    for t in range(n_frames):
+        mag_sum = 0.0
+        weighted_sum = 0.0
+        power_sum = 0.0
+        floored_sum = 0.0
+        log_sum = 0.0
+        for f in range(n_bins):
+            mag = S_mag[f, t]
+            power = mag * mag
+            mag_sum += mag
+            weighted_sum += freqs[f] * mag
+            power_sum += power
+            floored = max(power, 1e-10)
+            floored_sum += floored
+            log_sum += np.log(floored)
+        frame_power[t] = power_sum / n_bins
+        centroid[t] = weighted_sum / mag_sum if mag_sum > 0 else 0.0
+        # dc and nyquist bins count once, every other bin twice (both sides)
+        edges = 0.5 * (S_mag[0, t] ** 2 + S_mag[n_bins - 1, t] ** 2)
+        rms[t] = np.sqrt(2.0 * (power_sum - edges)) / N_FFT
+        flatness[t] = np.exp(log_sum / n_bins) / (floored_sum / n_bins)
+    return frame_power, centroid, rms, flatness
+
+
+def load_audio(file_path, full=False):
+    """load audio resampled to the analysis rate, converted to mono. unless full
+    is set, long songs are cut to the analysis excerpt"""
+    # decode straight to int16 pcm with libsndfile and resample in-process with
+    # soxr, avoiding librosa's float decode through audioread
     try:
-        # load audio at native sampling rate, convert to mono
-        y, sr = librosa.load(file_path, sr=None, mono=True)
-
-        # use GPU if available for computationally intensive operations
-        gpu_failed = False
-        if HAS_GPU:
-            try:
-                # transfer audio data to GPU
-                y_gpu = cp.asarray(y)
-
-                # FFT on GPU (for chroma and spectral features)
-                D = cp.abs(cp.fft.rfft(y_gpu))
-
-                # convert back to numpy for librosa compatibility
-                D_np = cp.asnumpy(D)
-                del D  # free GPU memory
-
-                # release GPU memory
-                del y_gpu
-
-                # continue with CPU operations using D_np where needed
-            except Exception as e:
-                # log the error and fall back to CPU processing
-                logger.warning(
-                    f"gpu processing failed for {file_path}, falling back to cpu: {e}"
-                )
-                gpu_failed = True
-                cp.get_default_memory_pool().free_all_blocks()  # clear GPU memory
-        else:
-            gpu_failed = True
+        with sf.SoundFile(file_path) as f:
+            native_sr = f.samplerate
+            frames = -1
+            # seek to the excerpt so the rest of the song is never decoded
+            if not full and f.frames > native_sr * (EXCERPT_OFFSET + EXCERPT_DURATION):
+                f.seek(native_sr * EXCERPT_OFFSET)
+                frames = native_sr * EXCERPT_DURATION
+            pcm = f.read(frames, dtype="int16", always_2d=True)
+        y = pcm.mean(axis=1, dtype=np.float32) / 32768.0
+        if native_sr == SAMPLE_RATE:
+            return y
+        return soxr.resample(y, native_sr, SAMPLE_RATE, quality="QQ")
+    except Exception as e:
+        logger.warning(f"fast decode failed for {file_path}, using librosa: {e}")
+
+    try:
+        y, _ = librosa.load(
+            file_path,
+            sr=SAMPLE_RATE,
+            mono=True,
+            res_type="soxr_qq",
+            dtype=np.float32,
+        )
+        excerpt_start = SAMPLE_RATE * EXCERPT_OFFSET
+        excerpt_end = excerpt_start + SAMPLE_RATE * EXCERPT_DURATION
+        if not full and len(y) > excerpt_end:
+            y = y[excerpt_start:excerpt_end]
+        return y
+    except Exception as e:
+        logger.error(f"error loading audio from {file_path}: {e}")
+        return None
 
-        if gpu_failed:
-            D_np = None  # not used in CPU path
+
+def extract_audio_features(song_ids, signals):
+    """extract audio features from several decoded songs, sharing one batched gpu
+    stft between them if available. returns (song_id, features) pairs, with None
+    for songs that failed"""
+    loaded = [i for i, y in enumerate(signals) if y is not None]
+    spectrograms = dict(zip(loaded, stft_magnitude([signals[i] for i in loaded])))
+    return [
+        (
+            song_id,
+            (
+                features_from_spectrogram(song_id, signals[i], spectrograms[i])
+                if i in spectrograms
+                else None
+            ),
+        )
+        for i, song_id in enumerate(song_ids)
+    ]
+
+
+def features_from_spectrogram(song_id, y, S_mag):
+    """compute the audio features of a song from its signal and magnitude stft"""
+    sr = SAMPLE_RATE
+    try:
+        # power and mel spectrograms from the shared stft, used by every
+        # spectral feature below
+        S_power = S_mag**2
+        mel_S = MEL_FB @ S_power
+        mel_db = librosa.power_to_db(mel_S)
 
         # extract features
         # mfcc - capture the spectral envelope of the audio (13 coefficients)
-        mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
+        mfcc = MFCC_DCT @ mel_db
+
+        # tempo and beats - a single beat_track on the onset envelope, which is
+        # derived from the shared mel spectrogram rather than a fresh stft
+        onset_env = librosa.onset.onset_strength(S=mel_db, sr=sr)
+        tempo_est, beat_frames = librosa.beat.beat_track(
+            onset_envelope=onset_env, sr=sr
+        )
+        tempo = float(np.atleast_1d(tempo_est)[0])  # tempo in BPM
 
-        # chroma STFT maps energy to 12 pitch classes (C to B)
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+        # chroma STFT maps energy to 12 pitch classes (C to B), each frame
+        # scaled so its strongest pitch class is 1
+        chroma = CHROMA_FB @ S_power
+        chroma /= np.maximum(
+            chroma.max(axis=0, keepdims=True), np.finfo(chroma.dtype).tiny
+        )
 
         # spectral contrast measures the difference between peaks and valleys in the spectrum
-        spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
+        spectral_contrast = librosa.feature.spectral_contrast(S=S_mag, sr=sr)
 
-        # harmonic/percussive source separation
-        y_harmonic, y_percussive = librosa.effects.hpss(y)
         eps = 1e-10  # avoid division by zero
 
-        # tempo
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-        try:
-            from librosa.feature.rhythm import tempo as compute_tempo
-
-            tempo_vals = compute_tempo(onset_envelope=onset_env, sr=sr)
-        except ImportError:
-            tempo_vals = librosa.beat.tempo(onset_envelope=onset_env, sr=sr)
-        tempo = float(tempo_vals[0])  # tempo in BPM
+        # per-frame power, centroid (Hz), rms and flatness in one pass over the stft
+        frame_power, centroid, rms, flatness = spectral_frame_stats(S_mag, FFT_FREQS)
+
+        # harmonic/percussive energy - approximated from the power spectrogram
+        # instead of a full hpss: frames with above-median onset strength (the
+        # mel spectral flux already computed for beat tracking) are treated as
+        # percussive, the rest as harmonic
+        perc_mask = onset_env > np.median(onset_env)
+        harmonic_energy = np.sqrt(frame_power[~perc_mask].mean())
+        percussive_energy = (
+            np.sqrt(frame_power[perc_mask].mean()) if perc_mask.any() else 0.0
+        )
 
         # additional features (optimize by reusing calculations)
 
-        # spectral centroid in Hz
-        centroid = librosa.feature.spectral_centroid(y=y, sr=sr)[0]
+        # centroid relative to its 95th percentile, shared by several features below
+        norm_centroid = centroid.mean() / (np.percentile(centroid, 95) + eps)
 
         # acousticness - ratio of non-percussive (harmonic) energy vs total energy
-        norm_centroid = np.mean(centroid) / (np.percentile(centroid, 95) + eps)
-        harmonic_energy = np.mean(librosa.feature.rms(y=y_harmonic))
-        percussive_energy = np.mean(librosa.feature.rms(y=y_percussive))
         hnr = harmonic_energy / (harmonic_energy + percussive_energy + eps)
         acoustic_component = 1.0 - norm_centroid
         # combine normalized spectral centroid (lower = more acoustic) and harmonic-to-noise ratio
@@ -167,19 +410,15 @@ def extract_audio_features(file_path):
 
         # energy - based on integrated loudness
         # compute integrated loudness via RMS and spectral centroid
-        rms = librosa.feature.rms(y=y)[0]
-        rms_norm = np.mean(rms) / (np.percentile(rms, 95) + eps)
-        centroid_norm = np.mean(centroid) / (np.percentile(centroid, 95) + eps)
-        energy = np.clip(0.5 * rms_norm + 0.5 * centroid_norm, 0.0, 1.0)
+        rms_norm = rms.mean() / (np.percentile(rms, 95) + eps)
+        energy = np.clip(0.5 * rms_norm + 0.5 * norm_centroid, 0.0, 1.0)
         loudness = librosa.amplitude_to_db(
             rms, ref=np.max
         ).mean()  # average loudness in dB
 
         # danceability - based on beat strength and regularity
-        # combines beat strength (PLP), tempo, and rhythmic regularity
-        pulse = librosa.beat.plp(onset_envelope=onset_env, sr=sr)
-        beat_strength = np.mean(pulse)
-        _, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
+        # combines beat strength (mean onset strength), tempo, and rhythmic regularity
+        beat_strength = onset_env.mean()
         if len(beat_frames) > 1:
             intervals = np.diff(librosa.frames_to_time(beat_frames, sr=sr))
             beat_reg = 1.0 - (np.std(intervals) / (np.mean(intervals) + eps))
@@ -199,7 +438,7 @@ def extract_audio_features(file_path):
         # live recordings often exhibit higher spectral flatness and zero-crossing rate
 
         # spectral flatness: live recordings often noisier
-        flatness = librosa.feature.spectral_flatness(y=y)[0].mean()
+        flatness = flatness.mean()
         # zero-crossing rate: live tracks often more dynamic
         zcr = librosa.feature.zero_crossing_rate(y=y)[0].mean()
         # combine and clamp
@@ -208,19 +447,15 @@ def extract_audio_features(file_path):
         # valence - based on spectral qualities that correlate with "happiness"
         # positiveness based on mode (major/minor) and brightness
         # mean chroma vector
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-        chroma_mean = np.mean(chroma, axis=1)
-        # key estimation
-        key = int(np.argmax(chroma_mean))  # 0-11 representing C, C#, D, etc.
-        # mode estimation (major vs minor)
-        # simplified approach: major tends to have stronger 3rd and 6th degrees
-        major_degrees = np.roll(chroma_mean, -key)[[4, 9]]  # major 3rd and 6th
-        minor_degrees = np.roll(chroma_mean, -key)[[3, 8]]  # minor 3rd and 6th
-        mode = 1 if np.mean(major_degrees) > np.mean(minor_degrees) else 0
-        spectral_brightness = np.mean(centroid) / (np.percentile(centroid, 95) + eps)
-        spectral_brightness = np.clip(spectral_brightness, 0.0, 1.0)
-        valence = 0.5 * float(mode) + 0.5 * spectral_brightness
-        valence = np.clip(valence, 0.0, 1.0)
+        chroma_mean = chroma.mean(axis=1)
+        # key and mode estimation - best matching of the 24 key templates, the
+        # first 12 are major keys and the last 12 minor
+        key_corrs = KEY_TEMPLATES @ (chroma_mean - chroma_mean.mean())
+        is_minor, key = divmod(int(key_corrs.argmax()), 12)  # key 0-11 is C, C#, D...
+        mode = 1 - is_minor  # major vs minor
+        # plain python scalars, np.clip on a single value costs more than the math
+        spectral_brightness = min(max(float(norm_centroid), 0.0), 1.0)
+        valence = 0.5 * mode + 0.5 * spectral_brightness  # already within [0, 1]
 
         # speechiness - based on presence of speech-like qualities
         # degree of spoken-word content vs music
@@ -232,54 +467,47 @@ def extract_audio_features(file_path):
         speechiness = np.clip(speechiness, 0.0, 1.0)
 
         # instrumentalness - inverse proxy for vocal presence using mel-spectrogram energy in vocal band
-        S = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128)
-        mel_freqs = librosa.mel_frequencies(n_mels=128, fmin=0, fmax=sr / 2)
-        vocal_idx = np.where((mel_freqs >= 300) & (mel_freqs <= 3000))[0]
-        vocal_energy = np.sum(S[vocal_idx, :])
-        total_energy_spec = np.sum(S)
+        vocal_energy = np.sum(mel_S[VOCAL_IDX, :])
+        total_energy_spec = np.sum(mel_S)
         vocal_ratio = vocal_energy / (total_energy_spec + eps)
         instrumentalness = np.clip(1.0 - vocal_ratio, 0.0, 1.0)
 
-        # take mean of features to reduce dimensionality and ensure they're Python lists of float values
-        mfcc_mean = [float(x) for x in np.mean(mfcc, axis=1).tolist()]
-        chroma_mean = [float(x) for x in chroma_mean.tolist()]
-        spectral_contrast_mean = [
-            float(x) for x in np.mean(spectral_contrast, axis=1).tolist()
-        ]
-
-        # create combined feature vector including all features
-        # ensure all values are explicit Python floats
-        feature_vector = (
-            mfcc_mean
-            + chroma_mean
-            + spectral_contrast_mean
-            + [
-                float(2),
-                float(acousticness),
-                float(danceability),
-                float(energy),
-                float(loudness),
-                float(liveness),
-                float(valence),
-                float(speechiness),
-                float(instrumentalness),
-                float(mode),
-                float(key),
-            ]
+        # take mean of features to reduce dimensionality
+        mfcc_mean = mfcc.mean(axis=1)
+        spectral_contrast_mean = spectral_contrast.mean(axis=1)
+
+        # create combined feature vector including all features, written
+        # straight into a preallocated array since its layout is fixed
+        feature_vector = np.empty(FEATURE_VECTOR_SIZE, dtype=np.float32)
+        offset = N_MFCC + N_CHROMA + N_CONTRAST
+        feature_vector[:N_MFCC] = mfcc_mean
+        feature_vector[N_MFCC : N_MFCC + N_CHROMA] = chroma_mean
+        feature_vector[N_MFCC + N_CHROMA : offset] = spectral_contrast_mean
+        feature_vector[offset:] = (
+            2,
+            acousticness,
+            danceability,
+            energy,
+            loudness,
+            liveness,
+            valence,
+            speechiness,
+            instrumentalness,
+            mode,
+            key,
         )
 
         # clear large variables to free memory
-        for var in ["y", "y_harmonic", "pulse", "onset_env"]:
+        for var in ["y", "S_mag", "S_power", "onset_env"]:
             if var in locals():
                 del locals()[var]
 
-        if HAS_GPU:
-            cp.get_default_memory_pool().free_all_blocks()
-
+        # tolist() yields python floats, which the driver encodes faster than
+        # iterating numpy scalars out of the arrays
         return {
-            "mfcc": mfcc_mean,
-            "chroma": chroma_mean,
-            "spectral_contrast": spectral_contrast_mean,
+            "mfcc": mfcc_mean.tolist(),
+            "chroma": chroma_mean.tolist(),
+            "spectral_contrast": spectral_contrast_mean.tolist(),
             "tempo": float(tempo),
             "acousticness": float(acousticness),
             "danceability": float(danceability),
@@ -294,145 +522,149 @@ def extract_audio_features(file_path):
             "feature_vector": feature_vector,
         }
     except Exception as e:
-        logger.error(f"error extracting features from {file_path}: {e}")
+        logger.error(f"error extracting features from song {song_id}: {e}")
         return None
 
 
-async def store_features_in_db(database, song_id, features):
-    """store the extracted audio features in the database"""
-    try:
-        # convert numpy arrays to lists for json serialization
-        mfcc_json = json.dumps(features["mfcc"])
-        chroma_json = json.dumps(features["chroma"])
-        spectral_contrast_json = json.dumps(features["spectral_contrast"])
+# song_audio_features columns, in the order rows are built by build_feature_values
+FEATURE_COLUMNS = (
+    "song_id",
+    "mfcc",
+    "chroma",
+    "spectral_contrast",
+    "tempo",
+    "acousticness",
+    "danceability",
+    "energy",
+    "loudness",
+    "liveness",
+    "valence",
+    "speechiness",
+    "instrumentalness",
+    "mode",
+    "key",
+    "feature_vector",
+)
 
-        feature_vector = [float(x) for x in features["feature_vector"]]
+# jsonb columns are sent to the upsert as binary float8[] parameters and converted
+# server-side with to_jsonb, only rows loaded with copy need them as json text
+JSONB_FEATURE_COLUMNS = {"mfcc", "chroma", "spectral_contrast"}
+
+# upsert a song's audio features, replacing any previously stored row. uses
+# positional parameters so asyncpg prepares it once per connection and reuses it
+UPSERT_FEATURES_QUERY = f"""
+    INSERT INTO song_audio_features ({", ".join(FEATURE_COLUMNS)})
+    VALUES ({", ".join(
+        f"to_jsonb(${i}::float8[])" if column in JSONB_FEATURE_COLUMNS else f"${i}"
+        for i, column in enumerate(FEATURE_COLUMNS, start=1)
+    )})
+    ON CONFLICT (song_id) DO UPDATE
+    SET {", ".join(f"{column} = EXCLUDED.{column}" for column in FEATURE_COLUMNS[1:])},
+        processed_at = CURRENT_TIMESTAMP
+"""
+
+
+def build_feature_values(song_id, features):
+    """build the row for storing a song's audio features, ordered as FEATURE_COLUMNS"""
+    return (
+        song_id,
+        features["mfcc"],
+        features["chroma"],
+        features["spectral_contrast"],
+        float(features["tempo"]),
+        float(features["acousticness"]),
+        float(features["danceability"]),
+        float(features["energy"]),
+        float(features["loudness"]),
+        float(features["liveness"]),
+        float(features["valence"]),
+        float(features["speechiness"]),
+        float(features["instrumentalness"]),
+        int(features["mode"]),
+        int(features["key"]),
+        features["feature_vector"].tolist(),
+    )
 
-        # check if entry already exists
-        existing = await database.fetch_one(
-            "SELECT 1 FROM song_audio_features WHERE song_id = :song_id",
-            values={"song_id": song_id},
-        )
 
-        if existing:
-            # update existing record
-            await database.execute(
-                """
-                UPDATE song_audio_features 
-                SET mfcc = :mfcc, chroma = :chroma, spectral_contrast = :spectral_contrast, 
-                    tempo = :tempo, acousticness = :acousticness, danceability = :danceability, 
-                    energy = :energy, loudness = :loudness, liveness = :liveness, valence = :valence, 
-                    speechiness = :speechiness, instrumentalness = :instrumentalness, mode = :mode, 
-                    key = :key, feature_vector = :feature_vector, 
-                    processed_at = CURRENT_TIMESTAMP
-                WHERE song_id = :song_id
-                """,
-                values={
-                    "mfcc": mfcc_json,
-                    "chroma": chroma_json,
-                    "spectral_contrast": spectral_contrast_json,
-                    "tempo": float(features["tempo"]),
-                    "acousticness": float(features["acousticness"]),
-                    "danceability": float(features["danceability"]),
-                    "energy": float(features["energy"]),
-                    "loudness": float(features["loudness"]),
-                    "liveness": float(features["liveness"]),
-                    "valence": float(features["valence"]),
-                    "speechiness": float(features["speechiness"]),
-                    "instrumentalness": float(features["instrumentalness"]),
-                    "mode": int(features["mode"]),
-                    "key": int(features["key"]),
-                    "feature_vector": feature_vector,
-                    "song_id": song_id,
-                },
-            )
+def build_copy_record(values):
+    """convert a row from build_feature_values for copy, which takes jsonb as text"""
+    return tuple(
+        json.dumps(value) if column in JSONB_FEATURE_COLUMNS else value
+        for column, value in zip(FEATURE_COLUMNS, values)
+    )
+
+
+async def store_features_in_db(database, song_features, stored_song_ids):
+    """store the extracted audio features for a batch of songs in the database.
+    songs without stored features are bulk loaded with copy, the rest upserted"""
+    if not song_features:
+        return True
+
+    new_rows = []
+    existing_rows = []
+    for song_id, features in song_features:
+        values = build_feature_values(song_id, features)
+        if song_id in stored_song_ids:
+            existing_rows.append(values)
         else:
-            # insert new record
-            await database.execute(
-                """
-                INSERT INTO song_audio_features 
-                (song_id, mfcc, chroma, spectral_contrast, tempo, acousticness, danceability, energy, loudness, liveness, valence, speechiness, instrumentalness, mode, key, feature_vector) 
-                VALUES (:song_id, :mfcc, :chroma, :spectral_contrast, :tempo, :acousticness, :danceability, :energy, :loudness, :liveness, :valence, :speechiness, :instrumentalness, :mode, :key, :feature_vector)
-                """,
-                values={
-                    "song_id": song_id,
-                    "mfcc": mfcc_json,
-                    "chroma": chroma_json,
-                    "spectral_contrast": spectral_contrast_json,
-                    "tempo": float(features["tempo"]),
-                    "acousticness": float(features["acousticness"]),
-                    "danceability": float(features["danceability"]),
-                    "energy": float(features["energy"]),
-                    "loudness": float(features["loudness"]),
-                    "liveness": float(features["liveness"]),
-                    "valence": float(features["valence"]),
-                    "speechiness": float(features["speechiness"]),
-                    "instrumentalness": float(features["instrumentalness"]),
-                    "mode": int(features["mode"]),
-                    "key": int(features["key"]),
-                    "feature_vector": feature_vector,
-                },
-            )
+            new_rows.append(build_copy_record(values))
 
+    try:
+        # one connection and one transaction so the batch commits once and is
+        # stored all-or-nothing
+        async with database.connection() as connection, connection.transaction():
+            if new_rows:
+                await connection.raw_connection.copy_records_to_table(
+                    "song_audio_features", records=new_rows, columns=FEATURE_COLUMNS
+                )
+            if existing_rows:
+                # the prepared upsert, run for every row
+                await connection.raw_connection.executemany(
+                    UPSERT_FEATURES_QUERY, existing_rows
+                )
+        stored_song_ids.update(song_id for song_id, _ in song_features)
         return True
+    except asyncpg.UniqueViolationError:
+        # another run stored some of these songs since they were preloaded,
+        # retry the whole batch as upserts
+        stored_song_ids.update(song_id for song_id, _ in song_features)
+        return await store_features_in_db(database, song_features, stored_song_ids)
     except Exception as e:
-        logger.error(f"database error when storing features for song {song_id}: {e}")
+        logger.error(
+            f"database error when storing features for {len(song_features)} songs: {e}"
+        )
         return False
 
 
-def process_song_sync(song_id, songs_dir):
-    """synchronous version of process_song for parallel execution"""
-    song_path = os.path.join(songs_dir, f"{song_id}.mp3")
-
-    if not os.path.exists(song_path):
-        logger.warning(f"song file not found: {song_path}")
-        return song_id, None
+async def store_batch(
+    database, song_features, stored_song_ids, processed_song_ids, processed_log
+):
+    """store a batch of extracted features and record the songs as processed"""
+    if not await store_features_in_db(database, song_features, stored_song_ids):
+        return 0
 
-    logger.info(f"processing song: {song_id}")
-    features = extract_audio_features(song_path)
-    return song_id, features
-
-
-async def process_batch(database, batch_song_ids, processed_song_ids):
-    """process a batch of songs in parallel using a thread pool"""
-    start_time = time.time()
-
-    # create thread pool for parallel feature extraction
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # submit all tasks to the executor
-        future_to_song = {
-            executor.submit(process_song_sync, song_id, SONGS_DIR): song_id
-            for song_id in batch_song_ids
-        }
-
-        # process results as they complete
-        batch_processed = 0
-        for future in concurrent.futures.as_completed(future_to_song):
-            song_id, features = future.result()
-
-            if features:
-                # store features in database
-                success = await store_features_in_db(database, song_id, features)
-                if success:
-                    with pickle_lock:
-                        processed_song_ids.add(song_id)
-                    batch_processed += 1
-
-    batch_time = time.time() - start_time
-    songs_per_second = len(batch_song_ids) / batch_time if batch_time > 0 else 0
-    logger.info(
-        f"Processed batch of {len(batch_song_ids)} songs in {batch_time:.2f}s "
-        f"({songs_per_second:.2f} songs/sec). Successfully processed: {batch_processed}"
-    )
-
-    return batch_processed
+    stored_ids = [song_id for song_id, _ in song_features]
+    append_processed_song_ids(processed_log, stored_ids)
+    processed_song_ids.update(stored_ids)
+    return len(stored_ids)
 
 
 async def main():
     """main function to extract features from songs"""
+    # parse command line arguments
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extract audio features from songs")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help=f"analyze whole songs instead of a {EXCERPT_DURATION}s excerpt",
+    )
+    args = parser.parse_args()
+
     start_time = time.time()
     logger.info(
-        f"starting audio feature extraction process with {MAX_WORKERS} worker threads"
+        f"starting audio feature extraction process with {CPU_WORKERS} worker processes"
     )
     if HAS_GPU:
         logger.info("GPU acceleration enabled")
@@ -461,65 +693,144 @@ async def main():
         processed_song_ids = load_processed_song_ids()
         logger.info(f"{len(processed_song_ids)} songs already processed")
 
-        # filter out already processed songs
-        songs_to_process = [
+        # songs whose features are already stored, loaded once up front so songs
+        # missing from the log aren't extracted and written again, and so new
+        # rows can be bulk loaded instead of upserted
+        stored_song_ids = await get_stored_song_ids(database)
+        logger.info(f"{len(stored_song_ids)} songs already have features stored")
+        processed_song_ids |= stored_song_ids
+
+        # songs that have been downloaded, checked once instead of per song
+        downloaded_song_ids = {
+            file_name[:-4]
+            for file_name in os.listdir(SONGS_DIR)
+            if file_name.endswith(".mp3")
+        }
+
+        # filter out already processed and not yet downloaded songs
+        unprocessed_song_ids = [
             song_id for song_id in all_song_ids if song_id not in processed_song_ids
         ]
+        songs_to_process = [
+            song_id
+            for song_id in unprocessed_song_ids
+            if song_id in downloaded_song_ids
+        ]
         total_songs = len(songs_to_process)
-        logger.info(f"{total_songs} songs to process")
+        logger.info(
+            f"{total_songs} songs to process, skipping "
+            f"{len(unprocessed_song_ids) - total_songs} songs without an audio file"
+        )
 
         if not songs_to_process:
             logger.info("No songs to process. Exiting.")
             return
 
-        # process songs in batches for better memory management and progress tracking
+        # append processed ids to the log instead of rewriting the full set
+        # every batch
+        processed_log = open(PROCESSED_SONGS_FILE, "a")
+
+        # stream every song through one persistent process pool, keeping at most
+        # MAX_IN_FLIGHT tasks submitted so slow songs don't leave workers idle.
+        # with a gpu each task is a group of songs sharing one batched stft.
+        # tasks decode their audio on a thread pool first, so decoding the next
+        # songs overlaps with feature extraction in the worker processes
+        loop = asyncio.get_running_loop()
+        songs_per_task = GPU_BATCH_SIZE if HAS_GPU else 1
+        song_iter = (
+            songs_to_process[i : i + songs_per_task]
+            for i in range(0, total_songs, songs_per_task)
+        )
+        in_flight = set()
+        song_features = []
+        completed = 0
         total_processed = 0
-        for i in range(0, total_songs, BATCH_SIZE):
-            batch = songs_to_process[i : i + BATCH_SIZE]
-            logger.info(
-                f"Processing batch {i//BATCH_SIZE + 1}/{(total_songs+BATCH_SIZE-1)//BATCH_SIZE} "
-                f"({len(batch)} songs)"
-            )
-
-            # process batch
-            batch_processed = await process_batch(database, batch, processed_song_ids)
-            total_processed += batch_processed
-
-            # save progress after each batch
-            save_processed_song_ids(processed_song_ids)
-
-            # progress report
-            progress = (i + len(batch)) / total_songs
-            elapsed = time.time() - start_time
-            songs_per_second = (i + len(batch)) / elapsed if elapsed > 0 else 0
-            eta = (
-                (total_songs - (i + len(batch))) / songs_per_second
-                if songs_per_second > 0
-                else 0
-            )
-
-            logger.info(
-                f"Overall progress: {progress:.1%} ({total_processed}/{total_songs} songs processed successfully)"
-            )
-            logger.info(f"Elapsed time: {elapsed:.2f}s. ETA: {eta:.2f}s")
-
-            # report memory usage
-            memory = psutil.virtual_memory()
-            logger.info(
-                f"Memory usage: {memory.percent}% ({memory.used / (1024**3):.1f}GB / {memory.total / (1024**3):.1f}GB)"
-            )
-
-            # clear some memory if needed
-            if memory.percent > 80:
-                import gc
-
-                gc.collect()
-                if HAS_GPU:
-                    cp.get_default_memory_pool().free_all_blocks()
-                logger.info("Forced garbage collection to free memory")
-
-        # save final progress
-        save_processed_song_ids(processed_song_ids)
+
+        # spawn rather than fork so workers never inherit cuda or numba thread state
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=CPU_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=MAX_TASKS_PER_CHILD,
+        ) as executor, concurrent.futures.ThreadPoolExecutor(
+            max_workers=IO_WORKERS
+        ) as io_pool:
+
+            async def process_songs(song_ids):
+                signals = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(
+                            io_pool,
+                            load_audio,
+                            os.path.join(SONGS_DIR, f"{song_id}.mp3"),
+                            args.full,
+                        )
+                        for song_id in song_ids
+                    )
+                )
+                logger.info(f"processing songs: {', '.join(song_ids)}")
+                return await loop.run_in_executor(
+                    executor, extract_audio_features, song_ids, signals
+                )
+
+            def submit(song_ids):
+                in_flight.add(asyncio.ensure_future(process_songs(song_ids)))
+
+            for song_ids in itertools.islice(song_iter, MAX_IN_FLIGHT):
+                submit(song_ids)
+
+            while in_flight:
+                done, _ = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    in_flight.remove(future)
+                    for song_id, features in future.result():
+                        completed += 1
+                        if features:
+                            song_features.append((song_id, features))
+
+                    # keep the window full
+                    next_song_ids = next(song_iter, None)
+                    if next_song_ids is not None:
+                        submit(next_song_ids)
+
+                # flush completed songs to the database in batches
+                if len(song_features) < BATCH_SIZE and in_flight:
+                    continue
+
+                total_processed += await store_batch(
+                    database,
+                    song_features,
+                    stored_song_ids,
+                    processed_song_ids,
+                    processed_log,
+                )
+                song_features = []
+
+                # progress report
+                progress = completed / total_songs
+                elapsed = time.time() - start_time
+                songs_per_second = completed / elapsed if elapsed > 0 else 0
+                eta = (
+                    (total_songs - completed) / songs_per_second
+                    if songs_per_second > 0
+                    else 0
+                )
+
+                logger.info(
+                    f"Overall progress: {progress:.1%} ({total_processed}/{total_songs} songs processed successfully)"
+                )
+                logger.info(f"Elapsed time: {elapsed:.2f}s. ETA: {eta:.2f}s")
+
+                # report memory usage
+                memory = psutil.virtual_memory()
+                logger.info(
+                    f"Memory usage: {memory.percent}% ({memory.used / (1024**3):.1f}GB / {memory.total / (1024**3):.1f}GB)"
+                )
+
+        # save final progress, compacting the log
+        processed_log.close()
+        compact_processed_song_ids(processed_song_ids)
 
         # final report
         total_time = time.time() - start_time
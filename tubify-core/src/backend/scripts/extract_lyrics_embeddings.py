@@ -3,15 +3,20 @@ import os
 import pickle
 import logging
 import re
+import sqlite3
 import asyncio
+import concurrent.futures
+import random
+import threading
 import time
-from typing import List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 from dotenv import load_dotenv
 import lyricsgenius
 import psutil
 import numpy as np
-from langdetect import detect_langs, LangDetectException
+import torch
+from langdetect import DetectorFactory, detect_langs, LangDetectException
 from sentence_transformers import SentenceTransformer
 from databases import Database
 
@@ -26,18 +31,38 @@ if not DATABASE_URL:
 
 # embedding model settings
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
-DEVICE = (
-    "cuda"
-    if (psutil.cpu_count() and __import__("torch").cuda.is_available())
-    else "cpu"
-)
+DEVICE = "cuda" if (psutil.cpu_count() and torch.cuda.is_available()) else "cpu"
 BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 16))
+# optional cap on tokens per chunk (the model's own limit is 384); shorter
+# chunks mean cheaper attention per sequence, and lyrics are chunked to fit
+MAX_SEQ_LENGTH = os.getenv("EMBEDDING_MAX_SEQ_LENGTH")
+# cpu inference threads: the cores this process may run on rather than
+# torch's host-wide default
+try:
+    CPU_COUNT = len(os.sched_getaffinity(0))
+except AttributeError:
+    CPU_COUNT = psutil.cpu_count(logical=False) or 1
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", CPU_COUNT))
+# "torch" or "onnx"; onnx runs the exported graph through onnxruntime
+# (needs optimum[onnxruntime] installed)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# opt-in: int8 weights for cpu inference. embeddings drift slightly from the
+# float ones already stored, so keep one setting per corpus
+QUANTIZE_MODEL = os.getenv("EMBEDDING_QUANTIZE", "0") == "1" and DEVICE == "cpu"
+# opt-in: compiling pays off on long runs but takes a while to warm up
+COMPILE_MODEL = os.getenv("EMBEDDING_COMPILE", "0") == "1"
 
 # genius API rate & caching
 MAX_GENIUS_WORKERS = int(os.getenv("GENIUS_WORKERS", 2))
-GENIUS_DELAY = float(os.getenv("GENIUS_DELAY", 1.0))
-PROCESSED_FILE = os.getenv("PROCESSED_FILE", "processed_ids.pkl")
-CACHE_FILE = os.getenv("LYRICS_CACHE_FILE", "lyrics_cache.pkl")
+GENIUS_DELAY = float(os.getenv("GENIUS_DELAY", 0))
+GENIUS_RETRIES = int(os.getenv("GENIUS_RETRIES", 5))
+SONG_ID_PAGE_SIZE = 1000
+# append-only record of processed song ids, one per line
+PROCESSED_FILE = os.getenv("PROCESSED_FILE", "processed_ids.txt")
+# pickle written by earlier versions; only read to seed PROCESSED_FILE
+LEGACY_PROCESSED_FILE = "processed_ids.pkl"
+CACHE_FILE = os.getenv("LYRICS_CACHE_FILE", "lyrics_cache.sqlite")
+LEGACY_CACHE_FILE = "lyrics_cache.pkl"
 
 # logging
 logging.basicConfig(level=logging.INFO)
@@ -54,37 +79,112 @@ def load_pickle(path: str, default):
         return default
 
 
-def save_pickle(path: str, data):
-    tmp = f"{path}.tmp"
-    with open(tmp, "wb") as f:
-        pickle.dump(data, f)
-    os.replace(tmp, path)
+def load_processed_ids() -> Set[str]:
+    if os.path.exists(PROCESSED_FILE):
+        with open(PROCESSED_FILE, "rb") as f:
+            data = f.read()
+        # PROCESSED_FILE may still be configured to point at an old pickle
+        if not data.startswith(pickle.PROTO):
+            return {line.strip() for line in data.decode().splitlines() if line.strip()}
+        processed = set(pickle.loads(data))
+    else:
+        # first run with the text file: seed it from the legacy pickle
+        processed = set(load_pickle(LEGACY_PROCESSED_FILE, set()))
+    # ids are appended as text, so write the seed out as text first
+    compact_processed_ids(processed)
+    return processed
+
+
+# producer and writer both append from worker threads, and a text file
+# object isn't safe to write from two threads at once
+processed_log_lock = threading.Lock()
+
+
+def append_processed_ids(processed_log, song_ids):
+    if not song_ids:
+        return
+    with processed_log_lock:
+        processed_log.write("".join(f"{sid}\n" for sid in song_ids))
+        processed_log.flush()
+        os.fsync(processed_log.fileno())
+
+
+def compact_processed_ids(processed: Set[str]):
+    # rewrite the file with each id once
+    tmp = f"{PROCESSED_FILE}.tmp"
+    with open(tmp, "w") as f:
+        f.write("".join(f"{sid}\n" for sid in processed))
+    os.replace(tmp, PROCESSED_FILE)
+
+
+# compiled once; the cleaners run for every song
+SECTION_HEADER_RE = re.compile(r"\[.*?\]")
+EMBED_SUFFIX_RE = re.compile(r"\d*Embed\s*$")
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+TITLE_SUFFIX_RE = re.compile(
+    r"\s*(?:[-\(].*remaster.*|\(feat\..*\))", flags=re.IGNORECASE
+)
 
 
 def clean_lyrics(text: str) -> str:
-    text = re.sub(r"\[.*?\]", "", text)
-    text = re.sub(r"Embed|\d+Embed$", "", text)
-    text = re.sub(r"\n{3,}", "\n\n", text).strip()
-    return text
+    text = SECTION_HEADER_RE.sub("", text)
+    text = EMBED_SUFFIX_RE.sub("", text)
+    return BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def token_lengths(tokenizer, texts: List[str]) -> List[int]:
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
 
 
-def chunk_lyrics(text: str, max_chars: int = 1000) -> List[str]:
+def chunk_lyrics(text: str, tokenizer, max_tokens: int) -> List[str]:
+    # pack whole stanzas into chunks that fit the model's window so nothing
+    # is silently truncated; a stanza too long on its own is split by line
     stanzas = text.split("\n\n")
+    units = []
+    for stanza, n in zip(stanzas, token_lengths(tokenizer, stanzas)):
+        if n > max_tokens:
+            lines = stanza.split("\n")
+            units.extend(zip(lines, token_lengths(tokenizer, lines)))
+        else:
+            units.append((stanza, n))
+
     chunks, current, length = [], [], 0
-    for stanza in stanzas:
-        if length + len(stanza) + 2 > max_chars and current:
+    for unit, n in units:
+        if length + n > max_tokens and current:
             chunks.append("\n\n".join(current))
             current, length = [], 0
-        current.append(stanza)
-        length += len(stanza) + 2
+        current.append(unit)
+        length += n
     if current:
         chunks.append("\n\n".join(current))
     return chunks
 
 
+# langdetect samples n-grams at random; seed it so reruns agree
+DetectorFactory.seed = 0
+# the first couple of verses are enough to tell the language, and detection
+# cost grows with the length of the text
+LANGUAGE_SAMPLE_CHARS = 1000
+
+# optional fasttext language id model (lid.176.ftz); much faster and more
+# accurate than langdetect when available
+FASTTEXT_LID_MODEL = os.getenv("FASTTEXT_LID_MODEL")
+if FASTTEXT_LID_MODEL:
+    import fasttext
+
+    lid_model = fasttext.load_model(FASTTEXT_LID_MODEL)
+else:
+    lid_model = None
+
+
 def is_english(text: str) -> bool:
+    if lid_model is not None:
+        # fasttext predicts on a single line
+        sample = text[:LANGUAGE_SAMPLE_CHARS].replace("\n", " ")
+        labels, probs = lid_model.predict(sample, k=1)
+        return labels[0] == "__label__en" and probs[0] > 0.7
     try:
-        langs = detect_langs(text)
+        langs = detect_langs(text[:LANGUAGE_SAMPLE_CHARS])
         return any(lang.lang == "en" and lang.prob > 0.7 for lang in langs)
     except LangDetectException:
         return False
@@ -92,140 +192,340 @@ def is_english(text: str) -> bool:
 
 # genius lyrics fetch & cache
 
-cache = load_pickle(CACHE_FILE, {})
-cache_lock = asyncio.Lock()
-semaphore = asyncio.Semaphore(MAX_GENIUS_WORKERS)
-
 
 def clean_title(title: str) -> str:
-    title = re.sub(r"\s*[-\(].*remaster.*", "", title, flags=re.IGNORECASE)
-    return re.sub(r"\s*\(feat\..*\)", "", title, flags=re.IGNORECASE).strip()
+    return TITLE_SUFFIX_RE.sub("", title).strip()
+
+
+def open_lyrics_cache() -> sqlite3.Connection:
+    # sqlite rather than a pickled dict, so each fetch writes one row instead
+    # of re-dumping the whole cache
+    is_new = not os.path.exists(CACHE_FILE)
+    conn = sqlite3.connect(CACHE_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS lyrics ("
+        "title TEXT NOT NULL, artist TEXT NOT NULL, lyrics TEXT, "
+        "PRIMARY KEY (title, artist))"
+    )
+    # seed a new cache from the legacy pickle (left in place). it was keyed on
+    # the raw title, so re-key on the cleaned one fetch_lyrics looks up, with
+    # entries that have lyrics winning when several titles clean to the same key
+    legacy = load_pickle(LEGACY_CACHE_FILE, None) if is_new else None
+    if legacy:
+        entries = sorted(legacy.items(), key=lambda item: item[1] is None)
+        conn.executemany(
+            "INSERT OR IGNORE INTO lyrics VALUES (?, ?, ?)",
+            (
+                (clean_title(title).lower(), artist, lyrics)
+                for (title, artist), lyrics in entries
+            ),
+        )
+    conn.commit()
+    return conn
 
 
-async def fetch_lyrics(song: str, artist: str) -> Optional[str]:
-    key = (song.lower(), artist.lower())
-    async with cache_lock:
-        if key in cache:
-            return cache[key]
+cache = open_lyrics_cache()
+# lookups currently running, so concurrent requests for the same song share one
+inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+semaphore = asyncio.Semaphore(MAX_GENIUS_WORKERS)
+# one genius client per worker thread, so each keeps its http session alive
+genius_local = threading.local()
 
-    async with semaphore:
-        await asyncio.sleep(GENIUS_DELAY)
+
+def get_genius() -> lyricsgenius.Genius:
+    genius = getattr(genius_local, "client", None)
+    if genius is None:
         genius = lyricsgenius.Genius(GENIUS_TOKEN, sleep_time=0)
         genius.verbose = False
         genius.remove_section_headers = True
-        try:
-            result = genius.search_song(clean_title(song), artist)
-            if result and result.lyrics:
-                lyrics = clean_lyrics(result.lyrics)
-                if is_english(lyrics):
-                    async with cache_lock:
-                        cache[key] = lyrics
-                        save_pickle(CACHE_FILE, cache)
-                    return lyrics
-        except Exception as e:
-            logger.warning(f"genius fetch error for '{song}': {e}")
+        genius_local.client = genius
+    return genius
+
+
+def search_genius(title: str, artist: str) -> Optional[str]:
+    # blocking http + parsing, run off the event loop
+    genius = get_genius()
+    result = genius.search_song(title, artist)
+    if result and result.lyrics:
+        lyrics = clean_lyrics(result.lyrics)
+        if is_english(lyrics):
+            return lyrics
     return None
 
 
-# database helpers
+class LyricsFetchError(Exception):
+    """genius could not be reached for a song, as opposed to having no lyrics"""
 
 
-async def store_embedding(db: Database, song_id: str, lyrics: str, emb: List[float]):
-    exists = await db.fetch_one(
-        "SELECT 1 FROM song_lyrics WHERE song_id = :id", {"id": song_id}
-    )
-    if exists:
-        query = (
-            "UPDATE song_lyrics SET lyrics = :lyrics, lyrics_embedding = :emb, processed_at = NOW() "
-            "WHERE song_id = :id"
+async def fetch_lyrics(song: str, artist: str) -> Optional[str]:
+    title = clean_title(song)
+    # keyed on the cleaned title so remasters / features share one entry;
+    # None marks a song genius has no (english) lyrics for
+    key = (title.lower(), artist.lower())
+    row = cache.execute(
+        "SELECT lyrics FROM lyrics WHERE title = ? AND artist = ?", key
+    ).fetchone()
+    if row is not None:
+        return row[0]
+
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(lookup_lyrics(key, title, artist))
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return await task
+
+
+async def lookup_lyrics(key: Tuple[str, str], title: str, artist: str) -> Optional[str]:
+    async with semaphore:
+        await asyncio.sleep(GENIUS_DELAY)
+        for attempt in range(GENIUS_RETRIES + 1):
+            try:
+                lyrics = await asyncio.to_thread(search_genius, title, artist)
+                break
+            except Exception as e:
+                # lyricsgenius raises HTTPError(status, message); back off
+                # exponentially (with jitter) only when genius is throttling
+                # us or failing
+                status = e.args[0] if e.args and isinstance(e.args[0], int) else 0
+                if (status == 429 or status >= 500) and attempt < GENIUS_RETRIES:
+                    backoff = min(60, 2**attempt) + random.random()
+                    logger.info(
+                        f"genius returned {status} for '{title}', retrying in {backoff:.1f}s"
+                    )
+                    await asyncio.sleep(backoff)
+                    continue
+                logger.warning(f"genius fetch error for '{title}': {e}")
+                # errors are neither cached nor stored, so the song is
+                # retried next run
+                raise LyricsFetchError(title) from e
+
+    cache.execute("INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?)", (*key, lyrics))
+    cache.commit()
+    return lyrics
+
+
+# embedding
+
+
+def embed_lyrics(model, lyrics_list: List[str]) -> List[List[float]]:
+    # songs sharing lyrics (re-releases, album versions) are encoded once
+    unique_lyrics = list(dict.fromkeys(lyrics_list))
+
+    # leave room for the [CLS] / [SEP] tokens encode adds
+    max_tokens = model.max_seq_length - 2
+    chunks_flat, chunk_counts = [], []
+    for lyr in unique_lyrics:
+        chunks = chunk_lyrics(lyr, model.tokenizer, max_tokens)
+        chunks_flat.extend(chunks)
+        chunk_counts.append(len(chunks))
+
+    # encode every chunk of the batch in a single call. encode length-sorts
+    # its inputs so each sub-batch pads to similar lengths. inference_mode is
+    # thread-local, so it is entered here in the worker thread rather than
+    # around the to_thread call
+    with torch.inference_mode():
+        embs = model.encode(
+            chunks_flat,
+            batch_size=BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False,
         )
-    else:
-        query = (
-            "INSERT INTO song_lyrics(song_id, lyrics, lyrics_embedding) "
-            "VALUES(:id, :lyrics, :emb)"
+
+    # average each song's chunks with one matmul against a pooling matrix
+    # that weights every chunk by 1 / (its song's chunk count); every lyric
+    # yields at least one chunk
+    counts = np.array(chunk_counts)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    pooling = np.zeros((len(counts), len(owner)), dtype=np.float32)
+    pooling[owner, np.arange(len(owner))] = 1.0 / counts[owner]
+    means = pooling @ embs.astype(np.float32, copy=False)
+    embeddings = dict(zip(unique_lyrics, means.tolist()))
+    return [embeddings[lyr] for lyr in lyrics_list]
+
+
+# database helpers
+
+
+UPSERT_LYRICS_QUERY = """
+    INSERT INTO song_lyrics(song_id, lyrics, lyrics_embedding)
+    VALUES($1, $2, $3)
+    ON CONFLICT (song_id) DO UPDATE SET
+        lyrics = EXCLUDED.lyrics,
+        lyrics_embedding = EXCLUDED.lyrics_embedding,
+        processed_at = NOW()
+"""
+
+
+async def store_embeddings(db: Database, rows: List[Tuple[str, str, List[float]]]):
+    if not rows:
+        return
+    # databases' execute_many runs one statement per row; asyncpg's
+    # executemany sends the prepared upsert for every row in one round trip
+    async with db.connection() as connection:
+        await connection.raw_connection.executemany(UPSERT_LYRICS_QUERY, rows)
+
+
+async def iter_unprocessed_song_ids(db: Database):
+    # keyset-paged rather than db.iterate: the producer queries the same
+    # connection between pages, which an open cursor would block
+    last_id = ""
+    while True:
+        rows = await db.fetch_all(
+            """
+            SELECT s.id
+            FROM songs s
+            LEFT JOIN song_lyrics sl ON sl.song_id = s.id
+            WHERE sl.song_id IS NULL AND s.id > :last_id
+            ORDER BY s.id
+            LIMIT :limit
+            """,
+            {"last_id": last_id, "limit": SONG_ID_PAGE_SIZE},
         )
-    await db.execute(query, {"id": song_id, "lyrics": lyrics, "emb": emb})
+        if not rows:
+            return
+        yield [row["id"] for row in rows]
+        last_id = rows[-1]["id"]
+
+
+async def fetch_song_metadata(db: Database, song_ids: List[str]):
+    # one round trip per page instead of one per song; the first listed
+    # artist is the one genius files the song under
+    rows = await db.fetch_all(
+        """
+        SELECT s.id, s.name,
+               (array_agg(a.name ORDER BY sa.list_position))[1] AS artist
+        FROM songs s
+        JOIN song_artists sa ON s.id=sa.song_id
+        JOIN artists a ON sa.artist_id=a.id
+        WHERE s.id = ANY(:ids)
+        GROUP BY s.id
+        """,
+        {"ids": song_ids},
+    )
+    return {row["id"]: (row["name"], row["artist"]) for row in rows}
 
 
 # async pipeline
 
 
 async def producer(
-    song_ids: List[str], db: Database, out_q: asyncio.Queue, processed: Set[str]
+    db: Database, out_q: asyncio.Queue, processed: Set[str], processed_log
 ):
-    for sid in song_ids:
-        if sid in processed:
+    # keep a fixed number of genius lookups in flight, starting the next song
+    # as soon as any one finishes, so a slow or throttled song doesn't hold up
+    # the others; the semaphore in fetch_lyrics bounds the actual concurrency
+    max_in_flight = MAX_GENIUS_WORKERS * 4
+    # lookup task -> song id
+    in_flight = {}
+    misses = []
+
+    async def store_misses():
+        # songs without lyrics are stored empty so they are not retried
+        await store_embeddings(db, [(sid, "", []) for sid in misses])
+        processed.update(misses)
+        # the fsync can take milliseconds, so it runs off the event loop
+        await asyncio.to_thread(append_processed_ids, processed_log, misses)
+        misses.clear()
+
+    async def collect(return_when):
+        done, _ = await asyncio.wait(set(in_flight), return_when=return_when)
+        for task in done:
+            sid = in_flight.pop(task)
+            try:
+                lyrics = task.result()
+            except LyricsFetchError:
+                # not stored or logged, so the song is retried next run
+                continue
+            if lyrics:
+                await out_q.put((sid, lyrics))
+            else:
+                misses.append(sid)
+        if len(misses) >= max_in_flight:
+            await store_misses()
+
+    async for page in iter_unprocessed_song_ids(db):
+        todo = [sid for sid in page if sid not in processed]
+        if not todo:
             continue
-        row = await db.fetch_one(
-            """
-            SELECT s.name, string_agg(a.name, ',') AS artists
-            FROM songs s
-            JOIN song_artists sa ON s.id=sa.song_id
-            JOIN artists a ON sa.artist_id=a.id
-            WHERE s.id = :id
-            GROUP BY s.id
-            """,
-            {"id": sid},
-        )
-        if not row:
+        songs = await fetch_song_metadata(db, todo)
+        not_found = [sid for sid in todo if sid not in songs]
+        for sid in not_found:
             logger.warning(f"song id {sid} not found in database")
-            processed.add(sid)
-            continue
+        if not_found:
+            # recorded so later runs don't look them up again
+            processed.update(not_found)
+            await asyncio.to_thread(append_processed_ids, processed_log, not_found)
+        for sid in todo:
+            if sid not in songs:
+                continue
+            if len(in_flight) >= max_in_flight:
+                await collect(asyncio.FIRST_COMPLETED)
+            in_flight[asyncio.create_task(fetch_lyrics(*songs[sid]))] = sid
 
-        song, artist = row["name"], row["artists"].split(",")[0]
-        lyrics = await fetch_lyrics(song, artist)
-        if lyrics:
-            await out_q.put((sid, lyrics))
-        else:
-            await store_embedding(db, sid, "", [])
-            processed.add(sid)
-            save_pickle(PROCESSED_FILE, processed)
-            logger.info(f"saved {len(processed)} processed ids to {PROCESSED_FILE}")
+    if in_flight:
+        await collect(asyncio.ALL_COMPLETED)
+    if misses:
+        await store_misses()
+
+    # no more songs
+    await out_q.put(None)
 
 
-async def consumer(in_q: asyncio.Queue, db: Database, processed: Set[str], model):
+async def consumer(in_q: asyncio.Queue, out_q: asyncio.Queue, model):
     pending = []
-    processed_count = 0
+
+    async def encode_pending():
+        sids, lyrics_list = zip(*pending)
+        pending.clear()
+        # encode in a worker thread so genius fetches keep running meanwhile
+        embeddings = await asyncio.to_thread(embed_lyrics, model, lyrics_list)
+        await out_q.put(list(zip(sids, lyrics_list, embeddings)))
 
     while True:
+        # fill a whole batch before encoding, flushing early only once the
+        # producer has gone quiet
         try:
-            sid, lyrics = await asyncio.wait_for(in_q.get(), timeout=2)
-            pending.append((sid, lyrics))
+            item = await asyncio.wait_for(in_q.get(), timeout=2)
         except asyncio.TimeoutError:
-            if not pending:
-                continue
-        if len(pending) < BATCH_SIZE and not in_q.empty():
+            if pending:
+                await encode_pending()
             continue
-        sids, lyrics_list = zip(*pending)
-        # chunk & batch-encode
-        chunks_flat, idx_map = [], []
-        for idx, lyr in enumerate(lyrics_list):
-            chunks = chunk_lyrics(lyr)
-            for _ in chunks:
-                idx_map.append(idx)
-            chunks_flat.extend(chunks)
-        embs = model.encode(chunks_flat, batch_size=BATCH_SIZE)
-        aggregated = {}
-        for pos, emb in enumerate(embs):
-            aggregated.setdefault(idx_map[pos], []).append(emb)
-        for i, sid in enumerate(sids):
-            parts = aggregated.get(i, [])
-            final_emb = np.mean(parts, axis=0).tolist() if parts else []
-            await store_embedding(db, sid, lyrics_list[i], final_emb)
-            processed.add(sid)
-            processed_count += 1
-
-            # save processed set periodically
-            save_pickle(PROCESSED_FILE, processed)
-            logger.info(f"saved {len(processed)} processed ids to {PROCESSED_FILE}")
+        if item is None:
+            break
+        pending.append(item)
+        if len(pending) >= BATCH_SIZE:
+            await encode_pending()
+
+    if pending:
+        await encode_pending()
+    await out_q.put(None)
 
-        pending.clear()
+
+async def writer(in_q: asyncio.Queue, db: Database, processed: Set[str], processed_log):
+    # stores encoded batches while the consumer encodes the next one
+    while True:
+        rows = await in_q.get()
+        if rows is None:
+            break
+        await store_embeddings(db, rows)
+        sids = [sid for sid, _, _ in rows]
+        processed.update(sids)
+        await asyncio.to_thread(append_processed_ids, processed_log, sids)
+        logger.info(f"stored batch of {len(sids)}, {len(processed)} processed ids")
 
 
 async def main():
-    processed = set(load_pickle(PROCESSED_FILE, set()))
+    processed = load_processed_ids()
     logger.info(f"loaded {len(processed)} already processed ids from {PROCESSED_FILE}")
 
+    # one pool for every asyncio.to_thread call: a thread per genius worker
+    # (each keeping its own client), one for encoding and one for log writes
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_GENIUS_WORKERS + 2)
+    asyncio.get_running_loop().set_default_executor(executor)
+
     db = Database(DATABASE_URL)
     await db.connect()
 
@@ -236,35 +536,67 @@ async def main():
         f"total songs in database: {total_songs}, already processed in db: {total_processed_in_db}"
     )
 
-    logger.info(f"loading embedding model: {EMBEDDING_MODEL_NAME} on {DEVICE}")
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=DEVICE)
-
-    ids = [r["id"] for r in await db.fetch_all("SELECT id FROM songs")]
-    queue = asyncio.Queue(maxsize=BATCH_SIZE * 2)
+    logger.info(
+        f"loading embedding model: {EMBEDDING_MODEL_NAME} on {DEVICE} ({EMBEDDING_BACKEND})"
+    )
+    if DEVICE == "cpu":
+        torch.set_num_threads(EMBEDDING_THREADS)
+    model_kwargs = {}
+    if QUANTIZE_MODEL and EMBEDDING_BACKEND == "onnx":
+        # dynamically quantized export published alongside the model
+        model_kwargs["file_name"] = "onnx/model_quint8_avx2.onnx"
+    model = SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        device=DEVICE,
+        backend=EMBEDDING_BACKEND,
+        model_kwargs=model_kwargs,
+    )
+    if QUANTIZE_MODEL and EMBEDDING_BACKEND == "torch":
+        model[0].auto_model = torch.ao.quantization.quantize_dynamic(
+            model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    if MAX_SEQ_LENGTH:
+        model.max_seq_length = int(MAX_SEQ_LENGTH)
+    if not model.tokenizer.is_fast:
+        logger.warning("embedding model loaded a slow (python) tokenizer")
+    if EMBEDDING_BACKEND == "torch" and DEVICE == "cuda":
+        # half precision runs the transformer on tensor cores; embeddings are
+        # averaged back in float32 before they are stored
+        model.half()
+    if EMBEDDING_BACKEND == "torch" and COMPILE_MODEL:
+        # dynamic shapes, since every batch pads to a different length
+        model[0].auto_model = torch.compile(model[0].auto_model, dynamic=True)
+
+    # fetch -> encode -> store, each stage handing the next a bounded queue
+    # and a None once it is done
+    lyrics_q = asyncio.Queue(maxsize=BATCH_SIZE * 2)
+    rows_q = asyncio.Queue(maxsize=2)
+    processed_log = open(PROCESSED_FILE, "a")
+    tasks = [
+        asyncio.create_task(producer(db, lyrics_q, processed, processed_log)),
+        asyncio.create_task(consumer(lyrics_q, rows_q, model)),
+        asyncio.create_task(writer(rows_q, db, processed, processed_log)),
+    ]
 
     try:
-        prod_task = asyncio.create_task(producer(ids, db, queue, processed))
-        cons_task = asyncio.create_task(consumer(queue, db, processed, model))
-
-        await prod_task
-        await asyncio.sleep(2)
-        cons_task.cancel()
-
-        try:
-            await cons_task
-        except asyncio.CancelledError:
-            pass
-
+        await asyncio.gather(*tasks)
     finally:
-        # always save the processed set at the end
-        save_pickle(PROCESSED_FILE, processed)
+        # if a stage failed, stop the others before closing what they use
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # always compact the processed log at the end
+        processed_log.close()
+        compact_processed_ids(processed)
         logger.info(
             f"saved final set of {len(processed)} processed ids to {PROCESSED_FILE}"
         )
 
-        # save cache too
-        save_pickle(CACHE_FILE, cache)
-        logger.info(f"saved lyrics cache with {len(cache)} entries to {CACHE_FILE}")
+        # close the cache too
+        entries = cache.execute("SELECT COUNT(*) FROM lyrics").fetchone()[0]
+        cache.close()
+        logger.info(f"lyrics cache has {entries} entries in {CACHE_FILE}")
 
         await db.disconnect()
 
@@ -36,14 +36,14 @@ def recreate_downloaded_songs_cache():
 
     # scan directory for mp3 files and extract song ids
     downloaded_song_ids = set()
-    for file in os.listdir(SONGS_DIR):
-        file_path = os.path.join(SONGS_DIR, file)
-        # only process files (not directories)
-        if os.path.isfile(file_path):
-            # extract song id from filename (remove extension)
-            file_name = Path(file).stem
-            # assume file name is the song id
-            downloaded_song_ids.add(file_name)
+    # scandir entries carry the file type from the directory read, so this
+    # doesn't stat every file
+    with os.scandir(SONGS_DIR) as entries:
+        for entry in entries:
+            # only process files (not directories)
+            if entry.is_file():
+                # assume file name (without extension) is the song id
+                downloaded_song_ids.add(Path(entry.name).stem)
 
     print(f"found {len(downloaded_song_ids)} downloaded songs")
 
@@ -1,5 +1,4 @@
 import os
-import pickle
 import sys
 import asyncio
 from dotenv import load_dotenv
@@ -9,7 +8,7 @@ from databases import Database
 load_dotenv()
 
 # constants
-PROCESSED_FILE = os.getenv("PROCESSED_FILE", "processed_ids.pkl")
+PROCESSED_FILE = os.getenv("PROCESSED_FILE", "processed_ids.txt")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if not DATABASE_URL:
@@ -17,12 +16,12 @@ if not DATABASE_URL:
     sys.exit(1)
 
 
-def save_pickle(path, data):
-    """save data to a pickle file safely using a temporary file"""
+def save_ids(path, ids):
+    """save ids one per line safely using a temporary file"""
     tmp = f"{path}.tmp"
     try:
-        with open(tmp, "wb") as f:
-            pickle.dump(data, f)
+        with open(tmp, "w") as f:
+            f.write("".join(f"{song_id}\n" for song_id in ids))
         os.replace(tmp, path)
         return True
     except Exception as e:
@@ -48,7 +47,7 @@ async def recreate_processed_ids_cache():
         print(f"found {len(processed_ids)} songs with lyrics in the database")
 
         # save the set of song ids to the cache file
-        success = save_pickle(PROCESSED_FILE, processed_ids)
+        success = save_ids(PROCESSED_FILE, processed_ids)
         if success:
             print(
                 f"successfully saved {len(processed_ids)} song ids to {PROCESSED_FILE}"
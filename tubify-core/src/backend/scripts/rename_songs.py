@@ -24,14 +24,17 @@ def main():
         print(f"error: songs directory not found at {SONGS_DIR}")
         return
 
-    # get all files in the songs directory
-    files = os.listdir(SONGS_DIR)
+    # get all files in the songs directory; listed up front since the loop
+    # renames entries in the directory being scanned
+    with os.scandir(SONGS_DIR) as entries:
+        files = [entry for entry in entries if entry.is_file()]
     print(f"found {len(files)} files in songs directory")
 
     renamed_count = 0
     skipped_count = 0
 
-    for filename in files:
+    for entry in files:
+        filename = entry.name
         # check if file matches our expected pattern
         match = SONG_ID_PATTERN.match(filename)
 
@@ -43,7 +46,7 @@ def main():
             new_filename = f"{song_id}{extension}"
 
             # full paths
-            old_path = os.path.join(SONGS_DIR, filename)
+            old_path = entry.path
             new_path = os.path.join(SONGS_DIR, new_filename)
 
             # if the destination file already exists, skip
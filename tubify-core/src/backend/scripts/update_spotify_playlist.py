@@ -14,7 +14,10 @@ load_dotenv()
 # constants
 PLAYLIST_ID = "44QPZVGL4GSqgPutJbgY6z"
 USER_ID = 1
-CACHE_FILE = "added_song_ids.pkl"
+CACHE_FILE = "added_song_ids.txt"
+# pickle written by earlier versions; only read to seed CACHE_FILE
+LEGACY_CACHE_FILE = "added_song_ids.pkl"
+BATCH_SIZE = 100  # spotify api limit
 
 # spotify api constants
 SPOTIFY_SCOPES = [
@@ -32,6 +35,28 @@ SPOTIFY_SCOPES = [
 ]
 
 
+def load_added_song_ids():
+    """load the ids already added to the playlist, one per line"""
+    added_song_ids = set()
+    if os.path.exists(CACHE_FILE):
+        with open(CACHE_FILE, "r") as f:
+            added_song_ids.update(line.strip() for line in f if line.strip())
+    elif os.path.exists(LEGACY_CACHE_FILE):
+        # first run with the text file: seed it from the old pickle cache
+        with open(LEGACY_CACHE_FILE, "rb") as f:
+            added_song_ids = pickle.load(f)
+        with open(CACHE_FILE, "w") as f:
+            f.write("".join(f"{song_id}\n" for song_id in added_song_ids))
+    return added_song_ids
+
+
+def append_added_song_ids(cache, song_ids):
+    """record a batch as soon as spotify accepts it so a crash can't re-add it"""
+    cache.write("".join(f"{song_id}\n" for song_id in song_ids))
+    cache.flush()
+    os.fsync(cache.fileno())
+
+
 async def main():
     # initialize database
     database = Database(os.getenv("DATABASE_URL"))
@@ -40,10 +65,7 @@ async def main():
 
     try:
         # load set of song ids that have been added to the playlist already
-        added_song_ids = set()
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "rb") as f:
-                added_song_ids = pickle.load(f)
+        added_song_ids = load_added_song_ids()
         print(f"loaded {len(added_song_ids)} previously added song ids")
 
         # get spotify credentials for the user
@@ -100,55 +122,67 @@ async def main():
         # create spotify client
         sp = spotipy.Spotify(auth=access_token)
 
-        # get all songs from the database
-        songs = await database.fetch_all(
-            """
-            SELECT 
-                s.id, 
-                s.spotify_uri
-            FROM songs s
-            """
-        )
-        print(f"found {len(songs)} songs in database")
-
         print(f"playlist already has {len(added_song_ids)} tracks")
 
-        # find new songs to add
-        new_songs = []
-        for song in songs:
-            if song["id"] not in added_song_ids:
-                new_songs.append(song)
-
-        print(f"found {len(new_songs)} new songs to add")
-
-        # add songs in batches of 100 (spotify api limit)
-        if new_songs:
-            batch_size = 100
-            batches = [
-                new_songs[i : i + batch_size]
-                for i in range(0, len(new_songs), batch_size)
-            ]
-
-            total_added = 0
-            for batch in batches:
-                uris = [song["spotify_uri"] for song in batch]
-                try:
-                    sp.playlist_add_items(PLAYLIST_ID, uris)
+        # let the database skip songs already added and page through the rest
+        # by id, instead of loading every song and diffing in python. pages
+        # are fetched whole so no cursor is held open across spotify calls
+        total_added = 0
+        last_id = ""
+        # the added ids go into a temp table once, so each page is an indexed
+        # anti-join rather than a scan of a bound array; temp tables are per
+        # connection, so everything runs on one
+        async with database.connection() as connection:
+            await connection.execute(
+                "CREATE TEMP TABLE added_songs (id VARCHAR(255) PRIMARY KEY)"
+            )
+            await connection.raw_connection.copy_records_to_table(
+                "added_songs",
+                records=[(song_id,) for song_id in added_song_ids],
+                columns=["id"],
+            )
+            await connection.execute("ANALYZE added_songs")
+
+            with open(CACHE_FILE, "a") as cache:
+                while True:
+                    batch = await connection.fetch_all(
+                        """
+                        SELECT
+                            s.id,
+                            s.spotify_uri
+                        FROM songs s
+                        WHERE s.id > :last_id
+                          AND NOT EXISTS (SELECT 1 FROM added_songs a WHERE a.id = s.id)
+                        ORDER BY s.id
+                        LIMIT :limit
+                        """,
+                        values={"last_id": last_id, "limit": BATCH_SIZE},
+                    )
+                    if not batch:
+                        break
+                    last_id = batch[-1]["id"]
+
+                    # add songs in batches of 100 (spotify api limit); the
+                    # client is blocking, so it runs off the event loop
+                    try:
+                        await asyncio.to_thread(
+                            sp.playlist_add_items,
+                            PLAYLIST_ID,
+                            [song["spotify_uri"] for song in batch],
+                        )
+                    except Exception as e:
+                        print(f"error adding batch to playlist: {str(e)}")
+                        continue
+
+                    # update our added songs cache with the ids
+                    append_added_song_ids(cache, [song["id"] for song in batch])
                     total_added += len(batch)
-
-                    # update our added songs set with the ids
-                    added_song_ids.update([song["id"] for song in batch])
-
                     print(f"added batch of {len(batch)} songs")
-                except Exception as e:
-                    print(f"error adding batch to playlist: {str(e)}")
 
-            print(f"added {total_added} new songs to playlist")
+            await connection.execute("DROP TABLE added_songs")
 
-            # save the updated set of added song ids
-            with open(CACHE_FILE, "wb") as f:
-                pickle.dump(added_song_ids, f)
-            print(f"saved {len(added_song_ids)} song ids to cache file")
+        if total_added:
+            print(f"added {total_added} new songs to playlist")
         else:
             print("no new songs to add")
 
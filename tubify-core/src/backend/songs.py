@@ -42,12 +42,11 @@ async def search_spotify_songs(
             # get album art url (use the smallest image available)
             album_art_url = None
             if item["album"]["images"]:
-                # sort by size and get the smallest
-                images = sorted(item["album"]["images"], key=lambda x: x["height"] or 0)
-                album_art_url = images[0]["url"] if images else None
+                smallest = min(item["album"]["images"], key=lambda x: x["height"] or 0)
+                album_art_url = smallest["url"]
 
             # get artist names
-            artists = ", ".join([artist["name"] for artist in item["artists"]])
+            artists = ", ".join(artist["name"] for artist in item["artists"])
 
             tracks.append(
                 SpotifySearchResult(